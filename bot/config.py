@@ -1,22 +1,49 @@
+import functools
 import os
+import re
 from pathlib import Path
 
 from pydantic import BaseModel, ConfigDict, Field, field_validator
 
+try:
+    # Optional: google-re2 matches in linear time however many patterns are configured
+    import re2 as _rx_engine
+except ImportError:  # pragma: no cover - depends on the environment
+    _rx_engine = re
+
+_TRUTHY = frozenset({"1", "true", "yes", "y"})
+# List separators accepted in env values
+_SEP_RE = re.compile(r"[;,]")
+# One integer per comma/semicolon-separated token, surrounding whitespace allowed
+_ADMIN_ID_RE = re.compile(r"(?:^|[,;])\s*(-?\d+)\s*(?=[,;]|$)", re.ASCII)
+
+
+@functools.lru_cache(maxsize=8)
+def compile_shell_patterns(patterns: tuple[str, ...]) -> tuple[re.Pattern[str], ...]:
+    """Compile each allowlist pattern on its own, case-insensitively.
+
+    Uses google-re2 when it is installed and the stdlib ``re`` module otherwise. Patterns
+    are kept separate rather than joined into one alternation: a join would renumber groups
+    (breaking backreferences), reject inline global flags like "(?i)foo", and let a pattern
+    such as "x)|(?:.*" that is invalid alone compile into a match-everything branch.
+    """
+    return tuple(_compile_shell_pattern(p) for p in patterns)
+
+
+def _compile_shell_pattern(pattern: str) -> re.Pattern[str]:
+    try:
+        # Bare pattern first, so error positions refer to what the user wrote
+        _rx_engine.compile(pattern)
+    except Exception as e:
+        raise ValueError(f"{pattern!r}: {e}") from e
+    return _rx_engine.compile(f"(?i){pattern}")
+
 
 def _parse_admin_ids(raw: str | None) -> set[int]:
-    ids: set[int] = set()
     if not raw:
-        return ids
-    for part in raw.replace(";", ",").split(","):
-        p = part.strip()
-        if not p:
-            continue
-        try:
-            ids.add(int(p))
-        except ValueError:
-            continue
-    return ids
+        return set()
+    # Only whole integer tokens count; malformed ones like "12a" are skipped
+    return set(map(int, _ADMIN_ID_RE.findall(raw)))
 
 
 class Settings(BaseModel):
@@ -32,6 +59,10 @@ class Settings(BaseModel):
     log_backups: int = 5
     # Shell allowlist
     allowed_shell_prefixes: frozenset[str] = Field(default_factory=frozenset)
+    # Regexes a command name may fully match instead of an exact allowlist entry
+    allowed_shell_patterns: tuple[str, ...] = ()
+    # GNU long options rejected anywhere in a shell command (abbreviations included)
+    denied_shell_flags: frozenset[str] = Field(default_factory=frozenset)
     allow_power_cmds: bool = False
     command_timeout_sec: int = 20
     max_text_reply_chars: int = 3500
@@ -57,43 +88,84 @@ class Settings(BaseModel):
     @field_validator("allowed_shell_prefixes", mode="before")
     @classmethod
     def _normalize_allowlist(cls, v: object) -> frozenset[str]:
-        if v in (None, "", set(), frozenset()):
+        if not v:
             return frozenset()
         if isinstance(v, (set, frozenset, list, tuple)):
             return frozenset(s.strip().lower() for s in v if str(s).strip())
         s = str(v)
-        parts = (p.strip().lower() for p in s.replace(";", ",").split(","))
+        parts = (p.strip().lower() for p in _SEP_RE.split(s))
         return frozenset(p for p in parts if p)
 
+    @field_validator("allowed_shell_patterns", mode="before")
+    @classmethod
+    def _compile_patterns(cls, v: object) -> tuple[str, ...]:
+        if not v:
+            return ()
+        if isinstance(v, (list, tuple)):
+            items = [str(s) for s in v]
+        else:
+            # Whitespace-separated, since commas and semicolons are valid regex syntax
+            items = str(v).split()
+        patterns = tuple(dict.fromkeys(s.strip() for s in items if s.strip()))
+        try:
+            compile_shell_patterns(patterns)
+        except Exception as e:
+            raise ValueError(f"Invalid ALLOWED_SHELL_PATTERNS: {e}") from e
+        return patterns
+
+    @field_validator("denied_shell_flags", mode="before")
+    @classmethod
+    def _normalize_denied_flags(cls, v: object) -> frozenset[str]:
+        if not v:
+            return frozenset()
+        if isinstance(v, (set, frozenset, list, tuple)):
+            items = [str(s) for s in v]
+        else:
+            items = _SEP_RE.split(str(v))
+        # Store as "--name"; accept entries written with or without the leading dashes
+        names = (s.strip().lstrip("-") for s in items)
+        return frozenset(f"--{n}" for n in names if n)
+
 
+@functools.lru_cache(maxsize=1)
 def load_settings() -> Settings:
-    token = os.getenv("BOT_TOKEN", "").strip()
+    """Build Settings from the environment once per process.
+
+    The result is cached; call ``load_settings.cache_clear()`` after changing the environment.
+    """
+    # Snapshot the environment once instead of issuing a getenv per field
+    env = dict(os.environ)
+
+    token = env.get("BOT_TOKEN", "").strip()
     if not token:
         raise RuntimeError("BOT_TOKEN is not set. Define it in environment or .env file.")
 
-    admin_ids = _parse_admin_ids(os.getenv("ADMIN_USER_IDS"))
+    admin_ids = _parse_admin_ids(env.get("ADMIN_USER_IDS"))
     if not admin_ids:
         raise RuntimeError("ADMIN_USER_IDS is not set. Provide at least one Telegram user ID.")
 
-    allow_power_cmds = os.getenv("ALLOW_POWER_CMDS", "false").lower() in {"1", "true", "yes", "y"}
-    timeout = int(os.getenv("COMMAND_TIMEOUT_SEC", "20") or 20)
-    max_chars = int(os.getenv("MAX_TEXT_REPLY_CHARS", "3500") or 3500)
-    max_upload = int(os.getenv("MAX_UPLOAD_BYTES", str(45 * 1024 * 1024)))
+    allow_power_cmds = env.get("ALLOW_POWER_CMDS", "false").lower() in _TRUTHY
+    timeout = int(env.get("COMMAND_TIMEOUT_SEC", "20") or 20)
+    max_chars = int(env.get("MAX_TEXT_REPLY_CHARS", "3500") or 3500)
+    max_upload = int(env.get("MAX_UPLOAD_BYTES", str(45 * 1024 * 1024)))
 
-    base_dir_raw = os.getenv("BASE_DIR", ".")
+    base_dir_raw = env.get("BASE_DIR", ".")
     base_dir = Path(base_dir_raw).expanduser().resolve()
 
     # Logging
-    log_file_raw = os.getenv("LOG_FILE", "").strip()
+    log_file_raw = env.get("LOG_FILE", "").strip()
     log_file = Path(log_file_raw).expanduser().resolve() if log_file_raw else None
-    log_level = (os.getenv("LOG_LEVEL", "INFO") or "INFO").upper()
-    log_max_bytes = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
-    log_backups = int(os.getenv("LOG_BACKUPS", "5"))
+    log_level = (env.get("LOG_LEVEL", "INFO") or "INFO").upper()
+    log_max_bytes = int(env.get("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+    log_backups = int(env.get("LOG_BACKUPS", "5"))
 
     # Shell allowlist: normalize here for type-safety
-    raw_allow = os.getenv("ALLOWED_SHELL_PREFIXES", "")
-    parts = (p.strip().lower() for p in str(raw_allow).replace(";", ",").split(","))
+    raw_allow = env.get("ALLOWED_SHELL_PREFIXES", "")
+    parts = (p.strip().lower() for p in _SEP_RE.split(raw_allow))
     allowlist = frozenset(p for p in parts if p)
+    patterns = tuple(env.get("ALLOWED_SHELL_PATTERNS", "").split())
+    raw_denied = env.get("DENIED_SHELL_FLAGS", "")
+    denied_flags = frozenset(p.strip() for p in _SEP_RE.split(raw_denied))
 
     return Settings(
         token=token,
@@ -104,6 +176,8 @@ def load_settings() -> Settings:
         log_max_bytes=log_max_bytes,
         log_backups=log_backups,
         allowed_shell_prefixes=allowlist,
+        allowed_shell_patterns=patterns,
+        denied_shell_flags=denied_flags,
         allow_power_cmds=allow_power_cmds,
         command_timeout_sec=timeout,
         max_text_reply_chars=max_chars,
@@ -2,22 +2,40 @@ from __future__ import annotations
 
 import asyncio
 import contextlib
+import errno
+import functools
 import logging
 import os
 import shlex
+import stat
+from collections.abc import Awaitable
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Any, Callable
 
-import psutil
-from aiogram import F, Router, flags
+from aiogram import BaseMiddleware, F, Router, flags
 from aiogram.enums import ChatAction
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import Message, TelegramObject
 from aiogram.types.input_file import FSInputFile
 from aiogram.utils.chat_action import ChatActionMiddleware
 
-from .config import Settings
-from .utils import html_escape, human_bytes, run_shell, text_preview_or_file
+from .config import Settings, compile_shell_patterns
+from .utils import (
+    _SHELL_META,
+    CmdResult,
+    html_escape,
+    human_bytes,
+    run_shell,
+    text_preview_or_file,
+)
+
+# errnos that pathlib's exists()/is_file() report as "no such file" rather than raise
+_MISSING_ERRNOS = frozenset({errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP})
+# Characters through which bash can still rewrite an option name after shlex has split it
+_EXPANSION_CHARS = frozenset("$`{\\*?[")
+# Read size when streaming /download files to Telegram (aiogram default is 64 KiB)
+_DOWNLOAD_CHUNK = 1024 * 1024
 
 router = Router(name="core")
 router.message.middleware(ChatActionMiddleware())
@@ -40,16 +58,29 @@ HELP = (
 )
 
 
-def _ensure_inside(base_dir: Path, path: Path) -> None:
-    try:
-        base = base_dir.resolve()
-        target = path.resolve()
-    except FileNotFoundError:
-        # resolve will fail on missing parts; fall back to strict commonpath check on parent
-        base = base_dir.resolve()
-        target = path.parent.resolve()
-    if os.path.commonpath([str(base)]) != os.path.commonpath([str(base), str(target)]):
+@functools.lru_cache(maxsize=16)
+def _base_strings(base_dir: Path) -> tuple[str, str]:
+    """Return (base, base-with-trailing-sep) for containment checks, built once per BASE_DIR."""
+    base = os.fspath(base_dir)
+    return base, base if base.endswith(os.sep) else base + os.sep
+
+
+def _ensure_inside(base_dir: Path, path: str | os.PathLike[str]) -> Path:
+    """Return the resolved ``path``; raise PermissionError unless it is under ``base_dir``.
+
+    ``base_dir`` is expected to be resolved already (Settings.base_dir is, via its validator).
+    Callers should use the returned path: the one they passed in may only be normalized
+    lexically, e.g. "../link" that leaves BASE_DIR by name but resolves back inside.
+    """
+    base, prefix = _base_strings(base_dir)
+    # One realpath of the candidate; non-strict, so missing parts (upload targets) are fine.
+    # No lexical/lstat shortcut: a symlinked directory at any depth (or a missing leaf below
+    # one) can escape BASE_DIR, and only a walk of every component sees that
+    real = os.path.realpath(path)
+    # Common allow case first: a path below BASE_DIR; BASE_DIR itself is the rarer one
+    if not real.startswith(prefix) and real != base:
         raise PermissionError("Path escapes BASE_DIR")
+    return base_dir if real == base else Path(real)
 
 
 def _get_args(message: Message) -> str:
@@ -62,14 +93,41 @@ def _get_args(message: Message) -> str:
     return parts[1].strip()
 
 
-def _resolve_under(base_dir: Path, raw: str) -> Path:
+class CommandArgsMiddleware(BaseMiddleware):
+    """Split the command arguments once per message and inject them as ``cmd_args``."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if isinstance(event, Message):
+            data["cmd_args"] = _get_args(event)
+        return await handler(event, data)
+
+
+# Inner middleware: runs only for messages that matched a handler's filters
+router.message.middleware(CommandArgsMiddleware())
+
+
+def _resolve_under_str(base: str, raw: str) -> str:
+    """String-level core of _resolve_under; no PurePath parsing on the way."""
     raw = (raw or "").strip()
     if not raw or raw == ".":
-        return base_dir.resolve()
-    if raw.startswith("/") or raw.startswith("~"):
-        return Path(os.path.expanduser(raw)).resolve()
-    # relative to base_dir
-    return (base_dir / raw).resolve()
+        # Settings.base_dir is resolved once at load time; no need to hit the filesystem again
+        return base
+    if raw.startswith(("/", "~")):
+        return os.path.realpath(os.path.expanduser(raw))
+    # relative to base_dir: lexical only; _ensure_inside does the symlink-aware check
+    return os.path.normpath(os.path.join(base, raw))
+
+
+def _resolve_under(base_dir: Path, raw: str) -> Path:
+    base = os.fspath(base_dir)
+    resolved = _resolve_under_str(base, raw)
+    # Wrap in a Path once, at the boundary; reuse base_dir itself when nothing changed
+    return base_dir if resolved == base else Path(resolved)
 
 
 async def _send_text_or_file(message: Message, text: str, max_chars: int, prefix: str) -> None:
@@ -85,45 +143,104 @@ async def _send_text_or_file(message: Message, text: str, max_chars: int, prefix
                 os.remove(file_path)
 
 
+@functools.lru_cache(maxsize=1024)
+def _first_name(cmd: str) -> str | None:
+    """Return the lowercased basename of the executable, skipping a leading 'sudo'.
+
+    Plain whitespace split, at most three pieces: quoting is not interpreted, so a quoted or
+    escaped command name simply fails the allowlist rather than being unquoted first.
+    Cached, since the same command text tends to be sent (and validated) repeatedly.
+    """
+    parts = cmd.split(None, 2)
+    if not parts:
+        return None
+    head = parts[0].lower()
+    if head == "sudo" and len(parts) > 1:
+        head = parts[1].lower()
+    return os.path.basename(head)
+
+
+def _canonical_long_flag(token: str, denied: frozenset[str]) -> str | None:
+    """Return the denied long option that ``token`` spells, if any.
+
+    GNU getopt accepts any unambiguous prefix of a long option (``--compress-prog`` for
+    ``--compress-program``), so a token matches when it is a prefix of a denied flag.
+    An ``=value`` suffix is ignored.
+    """
+    name = token.split("=", 1)[0]
+    if name == "--":
+        return None
+    if name in denied:
+        return name
+    for flag in denied:
+        if flag.startswith(name):
+            return flag
+    return None
+
+
+def _is_denied_long_flag(token: str, denied: frozenset[str]) -> bool:
+    # Fail closed: an option name bash would still expand (e.g. "--compress-progra{m,}" or
+    # "--compress-prog$'ram'") cannot be compared reliably, so it counts as denied
+    if not _EXPANSION_CHARS.isdisjoint(token.split("=", 1)[0]):
+        return True
+    return _canonical_long_flag(token, denied) is not None
+
+
+def _has_denied_flag(cmd: str, denied: frozenset[str]) -> bool:
+    """Best-effort check; expansions that produce a whole option (e.g. "$opt") are not seen."""
+    try:
+        tokens = shlex.split(cmd, posix=True)
+    except ValueError:
+        tokens = cmd.split()
+    return any(_is_denied_long_flag(tok, denied) for tok in tokens if tok.startswith("--"))
+
+
 def _is_cmd_allowed(cmd: str, settings: Settings) -> bool:
-    """Return True if the command is allowed based on allowed_shell_prefixes.
+    """Return True if the command is allowed based on allowed_shell_prefixes/patterns.
 
-    Semantics: If allowed set is empty, all commands are allowed. Otherwise, we parse the
-    first executable token (handling optional leading 'sudo' and absolute paths) and require
-    that token to be exactly in the allowed set (case-insensitive, basename match).
+    Semantics: If both the allowed set and the pattern list are empty, all commands are
+    allowed. Otherwise, we take the first whitespace-separated token (handling optional
+    leading 'sudo' and absolute paths) and require its basename to be exactly in the
+    allowed set, or to fully match one of allowed_shell_patterns (case-insensitive).
+    Patterns are never tried on a name containing shell metacharacters, so a broad one
+    like "apt-.*" cannot admit "apt-;id".
+
+    Independently, any long option matching denied_shell_flags (including GNU-style
+    abbreviations) rejects the command before a subprocess is spawned.
     """
+    denied = settings.denied_shell_flags
+    if denied and _has_denied_flag(cmd or "", denied):
+        return False
     allowed = settings.allowed_shell_prefixes
-    if not allowed:
+    patterns = settings.allowed_shell_patterns
+    if not allowed and not patterns:
         return True
-    try:
-        parts = shlex.split(cmd or "", posix=True)
-    except Exception:
-        parts = (cmd or "").strip().split()
-    if not parts:
+    name = _first_name(cmd or "")
+    if name is None:
+        return False
+    # Settings already stores the allowlist stripped and lowercased
+    if name in allowed:
+        return True
+    if not _SHELL_META.isdisjoint(name):
         return False
-    idx = 0
-    if parts[0].lower() == "sudo" and len(parts) > 1:
-        idx = 1
-    first = parts[idx]
-    base = os.path.basename(first).lower()
-    allow_norm = {a.strip().lower() for a in allowed}
-    return base in allow_norm
+    return any(rx.fullmatch(name) for rx in compile_shell_patterns(patterns))
+
+
+@functools.lru_cache(maxsize=8)
+def _help_text(base_dir: Path) -> str:
+    # Only BASE_DIR varies, so render the static part once per base directory
+    return f"{HELP}\nBASE_DIR: <code>{html_escape(str(base_dir))}</code>"
 
 
 @router.message(Command("start"))
 @router.message(Command("help"))
 @flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
 async def cmd_help(message: Message, settings: Settings) -> None:
-    lines = [
-        HELP,
-        f"BASE_DIR: <code>{html_escape(str(settings.base_dir))}</code>",
-    ]
+    text = _help_text(settings.base_dir)
     # Add a hint with the sender's user ID to simplify admin configuration
     if message.from_user and message.from_user.id:
-        lines.append(
-            f"Your Telegram user ID: <code>{html_escape(str(message.from_user.id))}</code>"
-        )
-    await message.answer("\n".join(lines))
+        text += f"\nYour Telegram user ID: <code>{html_escape(str(message.from_user.id))}</code>"
+    await message.answer(text)
 
 
 @router.message(Command("ping"))
@@ -163,73 +280,65 @@ async def cmd_whoami(message: Message, settings: Settings) -> None:
     )
 
 
-@router.message(Command("sh"))
-@flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
-async def cmd_sh(message: Message, settings: Settings) -> None:
-    args = _get_args(message)
-    if not args:
-        await message.answer("Usage: /sh <command>", parse_mode=None)
-        return
-    if not _is_cmd_allowed(args, settings):
-        logging.warning("Command not allowed: %s", args)
-        await message.answer("Command not allowed by policy.")
-        return
-    res = await run_shell(args, timeout_sec=settings.command_timeout_sec)
-    combined: list[str] = []
-    combined.append(f"$ <code>{html_escape(args)}</code>\n")
+def _format_shell_result(cmd: str, res: CmdResult) -> str:
+    """Render a command and its result as a Telegram HTML reply."""
+    out = err = sep = ""
     if res.stdout:
-        try:
-            out = res.stdout.decode("utf-8", errors="replace")
-        except Exception:
-            out = "<binary stdout>\n"
-        combined.append(f"<pre>{html_escape(out)}</pre>")
+        out = f"<pre>{html_escape(res.stdout.decode('utf-8', errors='replace'))}</pre>"
     if res.stderr:
-        try:
-            err = res.stderr.decode("utf-8", errors="replace")
-        except Exception:
-            err = "<binary stderr>\n"
+        err = f"<pre>{html_escape(res.stderr.decode('utf-8', errors='replace'))}</pre>"
         if res.stdout:
-            combined.append("\n<b>[stderr]</b>\n")
-        combined.append(f"<pre>{html_escape(err)}</pre>")
-    combined.append(f"\n[exit {res.returncode}]")
+            sep = "\n<b>[stderr]</b>\n"
+    note = "\n[output truncated]" if res.truncated else ""
+    return f"$ <code>{html_escape(cmd)}</code>\n{out}{sep}{err}{note}\n[exit {res.returncode}]"
+
 
-    text = "".join(combined).strip()
+async def _run_and_reply(message: Message, cmd: str, settings: Settings) -> None:
+    if not _is_cmd_allowed(cmd, settings):
+        logging.warning("Command not allowed: %s", cmd)
+        await message.answer("Command not allowed by policy.")
+        return
+    res = await run_shell(
+        cmd,
+        timeout_sec=settings.command_timeout_sec,
+        max_output_bytes=settings.max_upload_bytes,
+    )
+    text = _format_shell_result(cmd, res)
     await _send_text_or_file(message, text, settings.max_text_reply_chars, prefix="cmd")
 
 
+@router.message(Command("sh"))
+@flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
+async def cmd_sh(message: Message, settings: Settings, cmd_args: str) -> None:
+    if not cmd_args:
+        await message.answer("Usage: /sh <command>", parse_mode=None)
+        return
+    await _run_and_reply(message, cmd_args, settings)
+
+
 @router.message(F.text.startswith("!"))
 @flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
 async def bang_shell(message: Message, settings: Settings) -> None:
     cmd = (message.text or "")[1:].strip()
     if not cmd:
         return
-    if not _is_cmd_allowed(cmd, settings):
-        logging.warning("Command not allowed: %s", cmd)
-        await message.answer("Command not allowed by policy.")
-        return
-    res = await run_shell(cmd, timeout_sec=settings.command_timeout_sec)
-    combined: list[str] = []
-    combined.append(f"$ <code>{html_escape(cmd)}</code>\n")
-    if res.stdout:
-        try:
-            out = res.stdout.decode("utf-8", errors="replace")
-        except Exception:
-            out = "<binary stdout>\n"
-        combined.append(f"<pre>{html_escape(out)}</pre>")
-    if res.stderr:
-        try:
-            err = res.stderr.decode("utf-8", errors="replace")
-        except Exception:
-            err = "<binary stderr>\n"
-        if res.stdout:
-            combined.append("\n<b>[stderr]</b>\n")
-        combined.append(f"<pre>{html_escape(err)}</pre>")
-    combined.append(f"\n[exit {res.returncode}]")
-    text = "".join(combined).strip()
-    await _send_text_or_file(message, text, settings.max_text_reply_chars, prefix="cmd")
+    await _run_and_reply(message, cmd, settings)
+
+
+def _stat_or_none(path: Path) -> os.stat_result | None:
+    """One stat() per request path instead of separate exists()/is_file()/stat() calls."""
+    try:
+        return path.stat()
+    except OSError as e:
+        # Same set pathlib ignores, so a symlink loop reads as "Not found" like before
+        if e.errno in _MISSING_ERRNOS:
+            return None
+        raise
 
 
-def _format_dir_entry(entry: Path) -> str:
+def _format_dir_entry(entry: os.DirEntry[str]) -> str:
+    # DirEntry reuses the type info from the directory read, so plain entries cost no extra
+    # syscall for is_dir(); stat() still follows symlinks like Path.stat() did.
     try:
         if entry.is_dir():
             return f"[D] {entry.name}/"
@@ -237,34 +346,54 @@ def _format_dir_entry(entry: Path) -> str:
         return f"[F] {entry.name} ({sz})"
     except PermissionError:
         return f"[?] {entry.name} <perm denied>"
+    except OSError:
+        # Dangling or looping symlink (ENOENT/ELOOP), or an entry that vanished mid-listing
+        return f"[?] {entry.name} <broken link>"
+
+
+def _entry_is_dir(entry: os.DirEntry[str]) -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        # e.g. ELOOP on a looping symlink; sorted with files, shown as a broken link
+        return False
+
+
+def _list_dir(path: Path) -> list[str]:
+    """Format directory entries, directories first, each group sorted by name."""
+    dirs: list[os.DirEntry[str]] = []
+    files: list[os.DirEntry[str]] = []
+    with os.scandir(path) as it:
+        for entry in it:
+            (dirs if _entry_is_dir(entry) else files).append(entry)
+    dirs.sort(key=lambda e: e.name.lower())
+    files.sort(key=lambda e: e.name.lower())
+    return [_format_dir_entry(entry) for entry in dirs + files]
 
 
 @router.message(Command("ls"))
 @flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
-async def cmd_ls(message: Message, settings: Settings) -> None:
-    arg = _get_args(message) or "."
+async def cmd_ls(message: Message, settings: Settings, cmd_args: str) -> None:
+    arg = cmd_args or "."
     path = _resolve_under(settings.base_dir, arg)
     try:
-        _ensure_inside(settings.base_dir, path)
+        path = _ensure_inside(settings.base_dir, path)
     except PermissionError:
         await message.answer("Path not allowed")
         return
 
-    if not path.exists():
+    info = _stat_or_none(path)
+    if info is None:
         await message.answer("Not found")
         return
 
-    if path.is_file():
-        info = path.stat()
+    if not stat.S_ISDIR(info.st_mode):
         await message.answer(
             f"FILE {path.relative_to(settings.base_dir)} ({human_bytes(info.st_size)})"
         )
         return
 
-    entries = [
-        _format_dir_entry(entry)
-        for entry in sorted(path.iterdir(), key=lambda p: (not p.is_dir(), p.name.lower()))
-    ]
+    entries = _list_dir(path)
     text = f"Listing {path.relative_to(settings.base_dir)}:\n" + "\n".join(entries)
     await _send_text_or_file(
         message, f"<pre>{html_escape(text)}</pre>", settings.max_text_reply_chars, prefix="ls"
@@ -273,19 +402,19 @@ async def cmd_ls(message: Message, settings: Settings) -> None:
 
 @router.message(Command("cat"))
 @flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
-async def cmd_cat(message: Message, settings: Settings) -> None:
-    arg = _get_args(message)
-    if not arg:
+async def cmd_cat(message: Message, settings: Settings, cmd_args: str) -> None:
+    if not cmd_args:
         await message.answer("Usage: /cat <path>")
         return
-    path = _resolve_under(settings.base_dir, arg)
+    path = _resolve_under(settings.base_dir, cmd_args)
     try:
-        _ensure_inside(settings.base_dir, path)
+        path = _ensure_inside(settings.base_dir, path)
     except PermissionError:
         await message.answer("Path not allowed")
         return
 
-    if not path.exists() or not path.is_file():
+    info = _stat_or_none(path)
+    if info is None or not stat.S_ISREG(info.st_mode):
         await message.answer("File not found")
         return
 
@@ -302,46 +431,46 @@ async def cmd_cat(message: Message, settings: Settings) -> None:
 
 @router.message(Command("download"))
 @flags.chat_action(action=ChatAction.UPLOAD_DOCUMENT, initial_sleep=0, interval=3)
-async def cmd_download(message: Message, settings: Settings) -> None:
-    arg = _get_args(message)
-    if not arg:
+async def cmd_download(message: Message, settings: Settings, cmd_args: str) -> None:
+    if not cmd_args:
         await message.answer("Usage: /download <path>", parse_mode=None)
         return
-    path = _resolve_under(settings.base_dir, arg)
+    path = _resolve_under(settings.base_dir, cmd_args)
     try:
-        _ensure_inside(settings.base_dir, path)
+        path = _ensure_inside(settings.base_dir, path)
     except PermissionError:
         await message.answer("Path not allowed")
         return
 
-    if not path.exists() or not path.is_file():
+    info = _stat_or_none(path)
+    if info is None or not stat.S_ISREG(info.st_mode):
         await message.answer("File not found")
         return
 
-    size = path.stat().st_size
+    size = info.st_size
     if size > settings.max_upload_bytes:
         await message.answer(
             f"File too large to upload: {human_bytes(size)} > {human_bytes(settings.max_upload_bytes)}"
         )
         return
 
-    await message.answer_document(FSInputFile(path))
+    # FSInputFile already streams from disk; larger chunks mean fewer reads for big files
+    await message.answer_document(FSInputFile(path, chunk_size=_DOWNLOAD_CHUNK))
 
 
 @router.message(Command("upload"))
 @flags.chat_action(action=ChatAction.UPLOAD_DOCUMENT, initial_sleep=0, interval=3)
-async def cmd_upload(message: Message, settings: Settings) -> None:
+async def cmd_upload(message: Message, settings: Settings, cmd_args: str) -> None:
     if not message.document:
         await message.answer("Attach a file and use caption: /upload <target_path>")
         return
-    arg = _get_args(message)
-    if not arg:
+    if not cmd_args:
         await message.answer("Usage: attach file with caption '/upload <target_path>'")
         return
 
-    target = _resolve_under(settings.base_dir, arg)
+    target = _resolve_under(settings.base_dir, cmd_args)
     try:
-        _ensure_inside(settings.base_dir, target)
+        target = _ensure_inside(settings.base_dir, target)
     except PermissionError:
         await message.answer("Path not allowed")
         return
@@ -372,6 +501,9 @@ async def cmd_upload(message: Message, settings: Settings) -> None:
 @router.message(Command("sysinfo"))
 @flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
 async def cmd_sysinfo(message: Message) -> None:
+    # Imported lazily: psutil loads its C extension and reads /proc, and only /sysinfo needs it
+    import psutil
+
     boot = datetime.fromtimestamp(psutil.boot_time())
     up = datetime.now() - boot
     cpu = psutil.cpu_percent(interval=0.5)
@@ -391,11 +523,11 @@ async def cmd_sysinfo(message: Message) -> None:
 
 @router.message(Command("power"))
 @flags.chat_action(action=ChatAction.TYPING, initial_sleep=0, interval=3)
-async def cmd_power(message: Message, settings: Settings) -> None:
+async def cmd_power(message: Message, settings: Settings, cmd_args: str) -> None:
     if not settings.allow_power_cmds:
         await message.answer("Power commands disabled.")
         return
-    arg = _get_args(message).lower()
+    arg = cmd_args.lower()
     if arg not in {"reboot", "shutdown"}:
         await message.answer("Usage: /power <reboot|shutdown>", parse_mode=None)
         return
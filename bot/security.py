@@ -1,15 +1,33 @@
 from __future__ import annotations
 
+import contextlib
 import logging
 from collections.abc import Awaitable
 from typing import Any, Callable
 
 from aiogram import BaseMiddleware
-from aiogram.types import CallbackQuery, Message, TelegramObject
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
 
 from .config import Settings
 
 
+def _from_message(event: Message) -> tuple[int | None, str]:
+    user_id = event.from_user.id if event.from_user else None
+    return user_id, event.text or event.caption or ""
+
+
+def _from_callback(event: CallbackQuery) -> tuple[int | None, str]:
+    user_id = event.from_user.id if event.from_user else None
+    return user_id, event.data or ""
+
+
+# Exact-type dispatch: one dict lookup per update instead of an isinstance chain
+_EXTRACTORS: dict[type[TelegramObject], Callable[[Any], tuple[int | None, str]]] = {
+    Message: _from_message,
+    CallbackQuery: _from_callback,
+}
+
+
 class AdminOnlyMiddleware(BaseMiddleware):
     """Blocks all interactions from non-admin users.
 
@@ -29,37 +47,31 @@ class AdminOnlyMiddleware(BaseMiddleware):
         # Inject settings for handler DI
         data["settings"] = self.settings
 
+        # Registered on dp.update, so unwrap to the concrete Message/CallbackQuery
+        inner = event
+        if type(event) is Update:
+            with contextlib.suppress(LookupError):  # unknown update type
+                inner = event.event
+
         # Only enforce admin checks for Message/CallbackQuery; bypass others quietly
-        if not isinstance(event, (Message, CallbackQuery)):
+        extractor = _EXTRACTORS.get(type(inner))
+        if extractor is None:
             return await handler(event, data)
-
-        # Narrow type for type-checkers
-        assert isinstance(event, (Message, CallbackQuery))
-
-        user_id: int | None = None
-        text: str | None = None
-
-        if isinstance(event, Message):
-            if event.from_user:
-                user_id = event.from_user.id
-            text = event.text or event.caption or ""
-        elif isinstance(event, CallbackQuery):
-            if event.from_user:
-                user_id = event.from_user.id
-            text = event.data or ""
+        user_id, text = extractor(inner)
 
         # Allow start/help for everyone to avoid confusion.
-        if isinstance(event, Message) and text:
-            low = text.lower()
-            if low.startswith("/start") or low.startswith("/help"):
+        if isinstance(inner, Message) and text:
+            # Lowercase only the prefix we compare; /sh payloads can be kilobytes long
+            head = text[:6].lower()
+            if head == "/start" or head.startswith("/help"):
                 return await handler(event, data)
 
         if user_id is None or user_id not in self.settings.admin_ids:
             logging.warning("Access denied for user_id=%s text=%r", user_id, (text or "")[:100])
-            if isinstance(event, Message):
-                await event.answer("Access denied. This bot is restricted to administrators.")
-            elif isinstance(event, CallbackQuery):
-                await event.answer("Access denied.", show_alert=True)
+            if isinstance(inner, Message):
+                await inner.answer("Access denied. This bot is restricted to administrators.")
+            elif isinstance(inner, CallbackQuery):
+                await inner.answer("Access denied.", show_alert=True)
             return None
 
         return await handler(event, data)
@@ -4,52 +4,157 @@ import asyncio
 import contextlib
 import html as _html
 import os
+import shlex
+import signal
 import tempfile
+from collections.abc import Callable
 from dataclasses import dataclass
 from pathlib import Path
 
+# StreamReader buffer limit for child pipes (asyncio default is 64 KiB); reads take up to this
+# much per wakeup, and the transport pauses the pipe once 2x this is buffered unread
+_STREAM_LIMIT = 1 << 20
+# Seconds between SIGTERM and SIGKILL when a command times out
+_TERM_GRACE_SEC = 0.2
+# Characters encoded per write when spilling long output to a file
+_SPILL_CHUNK = 1 << 16
+# Resolved once at import; prefer bash for better compatibility
+_SHELL = "/bin/bash" if Path("/bin/bash").exists() else "/bin/sh"
+# Anything that needs a shell to interpret: operators, expansions, globs, quoting, comments
+_SHELL_META = frozenset("|&;<>$`*?(){}[]\\\"'~#\n")
+
 
 @dataclass
 class CmdResult:
     returncode: int
     stdout: bytes
     stderr: bytes
+    truncated: bool = False
 
 
-async def run_shell(cmd: str, timeout_sec: float = 20.0) -> CmdResult:
-    """Run a shell command with timeout, returning stdout/stderr as bytes.
+async def _read_capped(
+    stream: asyncio.StreamReader,
+    buf: bytearray,
+    cap: int | None,
+    on_overflow: Callable[[], None],
+) -> None:
+    """Append stream chunks to buf until EOF, keeping at most cap bytes.
 
-    Uses bash if available for better compatibility. Falls back to /bin/sh.
+    Past the cap, on_overflow() is called once and the rest is read and discarded, so the
+    pipe still reaches EOF and its transport closes.
     """
-    shell = "/bin/bash" if Path("/bin/bash").exists() else "/bin/sh"
+    overflowed = False
+    while True:
+        chunk = await stream.read(_STREAM_LIMIT)
+        if not chunk:
+            return
+        if overflowed:
+            continue
+        if cap is not None and len(buf) + len(chunk) > cap:
+            buf += chunk[: cap - len(buf)]
+            overflowed = True
+            on_overflow()
+            continue
+        buf += chunk
+
+
+def _signal_group(proc: asyncio.subprocess.Process, sig: int) -> None:
+    # Commands run in their own session, so this reaches their children as well
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(proc.pid, sig)
+
+
+async def _spawn(cmd: str) -> asyncio.subprocess.Process:
+    """Start cmd, skipping the shell when it is a plain argv with no shell syntax."""
+    if not _SHELL_META.intersection(cmd):
+        argv = shlex.split(cmd)
+        if argv:
+            # Builtins (cd, export, ...), VAR=value prefixes and commands only on the
+            # login-shell PATH fail to exec; those simply go through the shell below.
+            with contextlib.suppress(OSError):
+                return await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True,
+                    limit=_STREAM_LIMIT,
+                )
     try:
-        proc = await asyncio.create_subprocess_exec(
-            shell,
+        return await asyncio.create_subprocess_exec(
+            _SHELL,
             "-lc",
             cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            limit=_STREAM_LIMIT,
         )
     except FileNotFoundError:
         # Extremely minimal systems; shell invocation is intended and controlled by admin users.
         # bandit: subprocess with shell is acceptable in this context.
-        proc = await asyncio.create_subprocess_shell(  # nosec B602
+        return await asyncio.create_subprocess_shell(  # nosec B602
             cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            limit=_STREAM_LIMIT,
         )
 
+
+async def run_shell(
+    cmd: str, timeout_sec: float = 20.0, max_output_bytes: int | None = None
+) -> CmdResult:
+    """Run a shell command with timeout, returning stdout/stderr as bytes.
+
+    Commands without shell syntax are exec'd directly; everything else runs via bash if
+    available for better compatibility, falling back to /bin/sh.
+    Output is read incrementally; if either stream exceeds max_output_bytes the process
+    is killed and the result is marked as truncated.
+    """
+    proc = await _spawn(cmd)
+
+    stdout = bytearray()
+    stderr = bytearray()
+    truncated = False
+
+    def _overflow() -> None:
+        nonlocal truncated
+        truncated = True
+        _signal_group(proc, signal.SIGKILL)
+
+    async def _collect() -> None:
+        assert proc.stdout is not None and proc.stderr is not None
+        await asyncio.gather(
+            _read_capped(proc.stdout, stdout, max_output_bytes, _overflow),
+            _read_capped(proc.stderr, stderr, max_output_bytes, _overflow),
+        )
+        await proc.wait()
+
     try:
-        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout_sec)
+        await asyncio.wait_for(_collect(), timeout=timeout_sec)
     except asyncio.TimeoutError:
-        proc.kill()
+        # Ask politely first so the command can clean up, then force whatever is left
+        _signal_group(proc, signal.SIGTERM)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(proc.wait(), timeout=_TERM_GRACE_SEC)
+        _signal_group(proc, signal.SIGKILL)
+        # Bounded: reap the child and drain the pipes so no transport is left open
         with contextlib.suppress(Exception):
-            await proc.wait()
+            assert proc.stdout is not None and proc.stderr is not None
+            await asyncio.wait_for(
+                asyncio.gather(proc.wait(), proc.stdout.read(), proc.stderr.read()),
+                timeout=_TERM_GRACE_SEC,
+            )
         return CmdResult(
             returncode=124, stdout=b"", stderr=f"Timeout after {timeout_sec}s".encode()
         )
 
-    return CmdResult(returncode=proc.returncode or 0, stdout=stdout or b"", stderr=stderr or b"")
+    return CmdResult(
+        returncode=proc.returncode or 0,
+        stdout=bytes(stdout),
+        stderr=bytes(stderr),
+        truncated=truncated,
+    )
 
 
 def text_preview_or_file(
@@ -66,9 +171,16 @@ def text_preview_or_file(
     if len(text) <= max_chars:
         return text, None
 
+    # Encode slice by slice onto the raw fd so only one chunk's bytes exist beside the text.
+    # Slicing a str never splits a code point, so the output equals a one-shot encode.
     fd, path = tempfile.mkstemp(prefix=f"{filename_prefix}_", suffix=".txt")
-    with os.fdopen(fd, "w", encoding="utf-8", errors="replace") as f:
-        f.write(text)
+    try:
+        for i in range(0, len(text), _SPILL_CHUNK):
+            data = memoryview(text[i : i + _SPILL_CHUNK].encode("utf-8", errors="replace"))
+            while data:
+                data = data[os.write(fd, data) :]
+    finally:
+        os.close(fd)
     return None, path
 
 
@@ -77,15 +189,13 @@ def normalize_path(raw: str) -> Path:
     return p
 
 
+_UNITS = ("B", "KB", "MB", "GB", "TB", "PB", "EB")
+
+
 def human_bytes(n: int) -> str:
-    step = 1024.0
-    units = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    v = float(n)
-    while v >= step and i < len(units) - 1:
-        v /= step
-        i += 1
-    return f"{v:.2f} {units[i]}"
+    # Unit index straight from the bit length: every 10 bits is another factor of 1024
+    i = min((n.bit_length() - 1) // 10, len(_UNITS) - 1) if n > 0 else 0
+    return f"{n / (1 << (i * 10)):.2f} {_UNITS[i]}"
 
 
 def html_escape(s: str) -> str:
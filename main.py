@@ -19,14 +19,25 @@ from bot.config import Settings, load_settings
 from bot.handlers import router as core_router
 from bot.security import AdminOnlyMiddleware
 
+_NOTIFY_CONCURRENCY = 5
+
 
 async def _notify_admins(bot: Bot, settings: Settings, text: str) -> None:
-    """Best-effort broadcast to all admin IDs; ignore per-recipient failures."""
-    tasks = [bot.send_message(uid, text) for uid in settings.admin_ids]
-    if not tasks:
+    """Best-effort broadcast to all admin IDs; ignore per-recipient failures.
+
+    At most _NOTIFY_CONCURRENCY sends are in flight to stay clear of Telegram rate limits.
+    """
+    ids = tuple(settings.admin_ids)
+    if not ids:
         return
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    for uid, res in zip(settings.admin_ids, results):
+    sem = asyncio.Semaphore(_NOTIFY_CONCURRENCY)
+
+    async def _send(uid: int) -> None:
+        async with sem:
+            await bot.send_message(uid, text)
+
+    results = await asyncio.gather(*(_send(uid) for uid in ids), return_exceptions=True)
+    for uid, res in zip(ids, results):
         if isinstance(res, Exception):
             logging.error("Failed to notify admin_id=%s: %s", uid, repr(res))
 
@@ -1,7 +1,32 @@
 # Ensure project root is importable as a package for tests
+import os
 import sys
+import tempfile
 from pathlib import Path
 
+import pytest
+from pytest_asyncio import is_async_test
+
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
+
+# Memory-backed temp root for tmp_path and tempfile spills, unless TMPDIR is set explicitly
+_SHM = Path("/dev/shm")
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    # pytest roots its numbered basetemp (and xdist its per-worker dirs) at
+    # tempfile.gettempdir(), so pointing that at tmpfs keeps retention and cleanup intact
+    if tempfile.tempdir is None and not os.environ.get("TMPDIR"):
+        if sys.platform == "linux" and os.access(_SHM, os.W_OK | os.X_OK):
+            tempfile.tempdir = str(_SHM)
+
+
+def pytest_collection_modifyitems(items: list[pytest.Item]) -> None:
+    # Share one event loop across all async tests (per xdist worker) instead of
+    # building and tearing down a selector loop for every test
+    session_loop = pytest.mark.asyncio(scope="session")
+    for item in items:
+        if is_async_test(item):
+            item.add_marker(session_loop, append=False)
@@ -1,8 +1,15 @@
 from pathlib import Path
 
 import pytest
+from pydantic import ValidationError
 
-from bot.config import _parse_admin_ids, load_settings
+from bot.config import Settings, _parse_admin_ids, load_settings
+
+
+@pytest.fixture(autouse=True)
+def _fresh_settings() -> None:
+    # load_settings() is cached per process; drop it so monkeypatched env is picked up
+    load_settings.cache_clear()
 
 
 def test_parse_admin_ids() -> None:
@@ -37,6 +44,8 @@ def test_load_settings_parses_logging_and_allowlist(
 
     # allowlist
     monkeypatch.setenv("ALLOWED_SHELL_PREFIXES", "ls, Echo ; UNAME ")
+    monkeypatch.setenv("ALLOWED_SHELL_PATTERNS", "apt-.*  python3(\\.\\d{1,2})?")
+    monkeypatch.setenv("DENIED_SHELL_FLAGS", "--compress-program; exec")
 
     s = load_settings()
     assert s.token == "t"
@@ -47,3 +56,26 @@ def test_load_settings_parses_logging_and_allowlist(
     assert s.log_max_bytes == 1024
     assert s.log_backups == 3
     assert s.allowed_shell_prefixes == {"ls", "echo", "uname"}
+    assert s.allowed_shell_patterns == ("apt-.*", r"python3(\.\d{1,2})?")
+    assert s.denied_shell_flags == {"--compress-program", "--exec"}
+
+
+def test_load_settings_is_cached(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("BOT_TOKEN", "t")
+    monkeypatch.setenv("ADMIN_USER_IDS", "1")
+    monkeypatch.setenv("BASE_DIR", str(tmp_path))
+
+    first = load_settings()
+    monkeypatch.setenv("ADMIN_USER_IDS", "2")
+    assert load_settings() is first
+
+    load_settings.cache_clear()
+    assert load_settings().admin_ids == {2}
+
+
+def test_invalid_shell_pattern_is_rejected(tmp_path: Path) -> None:
+    with pytest.raises(ValidationError, match="ALLOWED_SHELL_PATTERNS"):
+        Settings(token="t", admin_ids={1}, base_dir=tmp_path, allowed_shell_patterns=("apt-(",))
+    # Invalid alone, yet "(?:x)|(?:.*)" once joined: must not turn into an allow-all
+    with pytest.raises(ValidationError, match="ALLOWED_SHELL_PATTERNS"):
+        Settings(token="t", admin_ids={1}, base_dir=tmp_path, allowed_shell_patterns=("x)|(?:.*",))
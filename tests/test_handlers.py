@@ -1,17 +1,33 @@
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Any
 
 import pytest
+from aiogram.types import Chat, Message, TelegramObject
 
 from bot.config import Settings
-from bot.handlers import _ensure_inside, _is_cmd_allowed, _resolve_under
+from bot.handlers import (
+    CommandArgsMiddleware,
+    _ensure_inside,
+    _format_shell_result,
+    _is_cmd_allowed,
+    _list_dir,
+    _resolve_under,
+    _resolve_under_str,
+    _stat_or_none,
+)
+from bot.utils import CmdResult
 
 
-def mk_settings(tmp_path: Path, allowed: set[str] | None = None) -> Settings:
+def mk_settings(
+    tmp_path: Path, allowed: set[str] | None = None, denied_flags: set[str] | None = None
+) -> Settings:
     return Settings(
         token='t',
         admin_ids={1},
         base_dir=tmp_path,
         allowed_shell_prefixes=frozenset(allowed or set()),
+        denied_shell_flags=frozenset(denied_flags or set()),
     )
 
 
@@ -30,6 +46,88 @@ def test_is_cmd_allowed_exact_name_and_sudo_absolute(tmp_path: Path) -> None:
     assert not _is_cmd_allowed('bash -lc "id"', s)
 
 
+def test_is_cmd_allowed_only_inspects_head_tokens(tmp_path: Path) -> None:
+    s = mk_settings(tmp_path, {'ls'})
+    # Later tokens (even malformed ones) do not affect the decision
+    assert _is_cmd_allowed('ls "unterminated', s)
+    assert _is_cmd_allowed('sudo ls | grep "x', s)
+    assert not _is_cmd_allowed('sudo', s)
+    assert not _is_cmd_allowed('   ', s)
+    # Quoting is not interpreted: a quoted command name is not unquoted into an allowed one
+    assert not _is_cmd_allowed('"ls" -la', s)
+
+
+def test_is_cmd_allowed_denied_flags_match_gnu_abbreviations(tmp_path: Path) -> None:
+    s = mk_settings(tmp_path, {'sort'}, denied_flags={'--compress-program'})
+    assert _is_cmd_allowed('sort -r file.txt', s)
+    assert _is_cmd_allowed('sort --reverse -- file.txt', s)
+    assert not _is_cmd_allowed('sort --compress-program=sh file.txt', s)
+    assert not _is_cmd_allowed('sort --compress-prog sh file.txt', s)
+    assert not _is_cmd_allowed("sort '--compress-p=sh' file.txt", s)
+    # Option names bash would still expand are rejected outright; values are not inspected
+    assert not _is_cmd_allowed('sort --compress-progra{m,}=sh file.txt', s)
+    assert not _is_cmd_allowed("sort --compress-prog$'ram'=sh file.txt", s)
+    assert not _is_cmd_allowed('sort --compress-$v=sh file.txt', s)
+    assert not _is_cmd_allowed('sort --compress-`echo prog`=sh file.txt', s)
+    assert not _is_cmd_allowed('sort --rev* file.txt', s)
+    assert _is_cmd_allowed('sort --output=$HOME/out.txt file.txt', s)
+
+    # Denied flags apply even without an allowlist
+    s = mk_settings(tmp_path, denied_flags={'exec'})
+    assert _is_cmd_allowed('find . -name x', s)
+    assert not _is_cmd_allowed('tar --exec=id -cf x.tar .', s)
+
+
+def test_is_cmd_allowed_patterns_fullmatch_after_exact_set(tmp_path: Path) -> None:
+    s = Settings(
+        token='t',
+        admin_ids={1},
+        base_dir=tmp_path,
+        allowed_shell_prefixes=frozenset({'ls'}),
+        allowed_shell_patterns=('apt-.*', 'python3(\\.\\d+)?'),
+    )
+    assert _is_cmd_allowed('ls -la', s)
+    assert _is_cmd_allowed('sudo /usr/bin/apt-get update', s)
+    assert _is_cmd_allowed('APT-CACHE policy', s)
+    assert _is_cmd_allowed('python3.12 -V', s)
+    # The whole command name must match, not just a prefix of it
+    assert not _is_cmd_allowed('python3x -V', s)
+    assert not _is_cmd_allowed('xapt-get update', s)
+    # A broad pattern never matches a name that carries shell syntax
+    assert not _is_cmd_allowed('apt-;id', s)
+    assert not _is_cmd_allowed('apt-$(id)', s)
+    assert not _is_cmd_allowed('apt-x|sh', s)
+
+    # Each pattern keeps its own meaning: group numbers and inline flags are not shared
+    s = Settings(
+        token='t',
+        admin_ids={1},
+        base_dir=tmp_path,
+        allowed_shell_patterns=('(a)\\1', '(b)\\1', '(?s)zz'),
+    )
+    assert _is_cmd_allowed('aa', s)
+    assert _is_cmd_allowed('bb', s)
+    assert _is_cmd_allowed('ZZ', s)
+    assert not _is_cmd_allowed('ab', s)
+
+    # Patterns alone also restrict the shell
+    s = Settings(token='t', admin_ids={1}, base_dir=tmp_path, allowed_shell_patterns=('apt-.*',))
+    assert not _is_cmd_allowed('ls', s)
+    assert _is_cmd_allowed('apt-get -v', s)
+
+
+def test_format_shell_result_layout() -> None:
+    res = CmdResult(returncode=1, stdout=b'a<b\n', stderr=b'oops\n')
+    assert _format_shell_result('x && y', res) == (
+        '$ <code>x &amp;&amp; y</code>\n'
+        '<pre>a&lt;b\n</pre>\n<b>[stderr]</b>\n<pre>oops\n</pre>\n[exit 1]'
+    )
+    res = CmdResult(returncode=0, stdout=b'', stderr=b'\xff', truncated=True)
+    assert _format_shell_result('ls', res) == (
+        '$ <code>ls</code>\n<pre>\ufffd</pre>\n[output truncated]\n[exit 0]'
+    )
+
+
 def test_resolve_under_builds_paths(tmp_path: Path) -> None:
     base = tmp_path
     assert _resolve_under(base, '.') == base.resolve()
@@ -38,6 +136,9 @@ def test_resolve_under_builds_paths(tmp_path: Path) -> None:
     assert p.parts[-3:] == ('sub', 'dir', 'file.txt')
     abs_p = _resolve_under(base, '/tmp')
     assert abs_p.is_absolute()
+    # The string core agrees with the Path wrapper
+    assert _resolve_under_str(str(base), 'sub/../x') == str(base / 'x')
+    _ensure_inside(base, str(base / 'x'))
 
 
 def test_ensure_inside_blocks_escape(tmp_path: Path) -> None:
@@ -47,8 +148,102 @@ def test_ensure_inside_blocks_escape(tmp_path: Path) -> None:
     inside.write_text('x')
     # Should not raise
     _ensure_inside(base, inside)
+    # Missing targets (e.g. upload destinations) are fine as long as they stay inside
+    _ensure_inside(base, base / 'new' / 'file.txt')
+
+    # Sibling directory sharing the name prefix
+    sibling = base.parent / (base.name + '-other')
+    with pytest.raises(PermissionError):
+        _ensure_inside(base, sibling / 'x.txt')
+    with pytest.raises(PermissionError):
+        _ensure_inside(base, base / '..' / 'x.txt')
+
+    # Symlink inside BASE_DIR pointing outside of it
+    outside = base.parent / (base.name + '-target')
+    outside.mkdir(exist_ok=True)
+    (base / 'link').symlink_to(outside)
+    with pytest.raises(PermissionError):
+        _ensure_inside(base, _resolve_under(base, 'link/secret.txt'))
+    with pytest.raises(PermissionError):
+        _ensure_inside(base, _resolve_under(base, 'a/../../etc'))
+
+    # Lexically outside but resolving back inside: allowed, and the returned path is the
+    # resolved one, so handlers can relative_to() it
+    (base / 'sub').mkdir()
+    outlink = base.parent / (base.name + '-outlink')
+    outlink.symlink_to(base / 'sub')
+    real = _ensure_inside(base, _resolve_under(base, f'../{outlink.name}'))
+    assert real.relative_to(base) == Path('sub')
+    real = _ensure_inside(base, _resolve_under(base, f'../{outlink.name}/x.txt'))
+    assert real.relative_to(base) == Path('sub') / 'x.txt'
+    assert _ensure_inside(base, base) is base
+
+
+def test_ensure_inside_follows_symlinks_at_any_depth(tmp_path: Path) -> None:
+    base = tmp_path / 'base'
+    (base / 'd').mkdir(parents=True)
+    (base / 'real.txt').write_text('x')
+    outside = tmp_path / 'outside.txt'
+    outside.write_text('secret')
+
+    # Leaf symlinks are judged by their target
+    (base / 'ok').symlink_to(base / 'real.txt')
+    (base / 'leak').symlink_to(outside)
+    _ensure_inside(base, _resolve_under(base, 'ok'))
+    with pytest.raises(PermissionError):
+        _ensure_inside(base, _resolve_under(base, 'leak'))
+
+    # A plain file reached through a symlinked directory is caught too,
+    # which an lstat() of the leaf alone would miss
+    (base / 'd' / 'up').symlink_to(tmp_path)
+    with pytest.raises(PermissionError):
+        _ensure_inside(base, _resolve_under(base, 'd/up/outside.txt'))
 
     # Absolute outside
     etc = Path('/etc')
     with pytest.raises(PermissionError):
         _ensure_inside(base, etc)
+
+
+def test_stat_or_none_treats_missing_and_loops_as_absent(tmp_path: Path) -> None:
+    (tmp_path / 'f.txt').write_text('x')
+    (tmp_path / 'loop').symlink_to(tmp_path / 'loop')
+    info = _stat_or_none(tmp_path / 'f.txt')
+    assert info is not None and info.st_size == 1
+    assert _stat_or_none(tmp_path / 'missing') is None
+    assert _stat_or_none(tmp_path / 'f.txt' / 'child') is None
+    loop = _ensure_inside(tmp_path, _resolve_under(tmp_path, 'loop'))
+    assert _stat_or_none(loop) is None
+
+
+def test_list_dir_dirs_first_sorted(tmp_path: Path) -> None:
+    (tmp_path / 'b.txt').write_bytes(b'x' * 2048)
+    (tmp_path / 'A.txt').write_text('')
+    (tmp_path / 'zdir').mkdir()
+    (tmp_path / 'Cdir').mkdir()
+    (tmp_path / 'dangling').symlink_to(tmp_path / 'missing')
+    (tmp_path / 'loop').symlink_to(tmp_path / 'loop')
+    assert _list_dir(tmp_path) == [
+        '[D] Cdir/',
+        '[D] zdir/',
+        '[F] A.txt (0.00 B)',
+        '[F] b.txt (2.00 KB)',
+        '[?] dangling <broken link>',
+        '[?] loop <broken link>',
+    ]
+
+
+async def test_command_args_middleware_injects_args() -> None:
+    msg = Message(
+        message_id=1,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=1, type='private'),
+        text='/cat  some dir/file.txt ',
+    )
+    seen: dict[str, Any] = {}
+
+    async def handler(event: TelegramObject, data: dict[str, Any]) -> None:
+        seen.update(data)
+
+    await CommandArgsMiddleware()(handler, msg, {})
+    assert seen['cmd_args'] == 'some dir/file.txt'
@@ -0,0 +1,60 @@
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+import pytest
+from aiogram.types import Chat, Message, TelegramObject, Update, User
+
+from bot.config import Settings
+from bot.security import AdminOnlyMiddleware
+
+
+def mk_update(user_id: int, text: str) -> Update:
+    msg = Message(
+        message_id=1,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=user_id, type='private'),
+        from_user=User(id=user_id, is_bot=False, first_name='u'),
+        text=text,
+    )
+    return Update(update_id=1, message=msg)
+
+
+@pytest.fixture
+def replies(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    sent: list[str] = []
+
+    async def fake_answer(self: Message, text: str, **kwargs: Any) -> None:
+        sent.append(text)
+
+    monkeypatch.setattr(Message, 'answer', fake_answer)
+    return sent
+
+
+async def run_middleware(tmp_path: Path, update: Update) -> bool:
+    mw = AdminOnlyMiddleware(Settings(token='t', admin_ids={1}, base_dir=tmp_path))
+    called = False
+
+    async def handler(event: TelegramObject, data: dict[str, Any]) -> None:
+        nonlocal called
+        called = True
+        assert isinstance(data['settings'], Settings)
+
+    await mw(handler, update, {})
+    return called
+
+
+async def test_admin_update_reaches_handler(tmp_path: Path, replies: list[str]) -> None:
+    assert await run_middleware(tmp_path, mk_update(1, '/whoami'))
+    assert replies == []
+
+
+async def test_non_admin_update_is_denied(tmp_path: Path, replies: list[str]) -> None:
+    assert not await run_middleware(tmp_path, mk_update(2, '/sh id'))
+    assert replies == ['Access denied. This bot is restricted to administrators.']
+
+
+async def test_non_admin_may_ask_for_help(tmp_path: Path, replies: list[str]) -> None:
+    assert await run_middleware(tmp_path, mk_update(2, '/HELP'))
+    assert await run_middleware(tmp_path, mk_update(2, '/start'))
+    assert replies == []
@@ -1,23 +1,136 @@
+import asyncio
+import signal
 from pathlib import Path
+from typing import Protocol
 
 import pytest
 
-from bot.utils import human_bytes, run_shell, text_preview_or_file
+import bot.utils
+from bot.utils import _SPILL_CHUNK, human_bytes, run_shell, text_preview_or_file
 
 
-@pytest.mark.asyncio
+class FakeProc:
+    """Stand-in for asyncio.subprocess.Process driven by loop.call_later, no fork/exec."""
+
+    def __init__(self, duration: float, ignore_term: bool = False) -> None:
+        self.pid = -1
+        self.returncode: int | None = None
+        self.signals: list[int] = []
+        self.ignore_term = ignore_term
+        self.stdout = asyncio.StreamReader()
+        self.stderr = asyncio.StreamReader()
+        self._done = asyncio.Event()
+        asyncio.get_running_loop().call_later(duration, self._finish, 0)
+
+    def _finish(self, returncode: int) -> None:
+        if self.returncode is not None:
+            return
+        self.returncode = returncode
+        self.stdout.feed_eof()
+        self.stderr.feed_eof()
+        self._done.set()
+
+    def send_signal(self, sig: int) -> None:
+        self.signals.append(sig)
+        if sig == signal.SIGTERM and self.ignore_term:
+            return
+        self._finish(-sig)
+
+    async def wait(self) -> int:
+        await self._done.wait()
+        assert self.returncode is not None
+        return self.returncode
+
+
+class SpawnFake(Protocol):
+    def __call__(self, duration: float, ignore_term: bool = False) -> list[FakeProc]: ...
+
+
+@pytest.fixture
+def fake_spawn(monkeypatch: pytest.MonkeyPatch) -> SpawnFake:
+    """Route run_shell to FakeProc; call with its duration/ignore_term, get the spawned procs."""
+
+    def install(duration: float, ignore_term: bool = False) -> list[FakeProc]:
+        spawned: list[FakeProc] = []
+
+        async def spawn(cmd: str) -> FakeProc:
+            proc = FakeProc(duration, ignore_term=ignore_term)
+            spawned.append(proc)
+            return proc
+
+        monkeypatch.setattr(bot.utils, "_spawn", spawn)
+        monkeypatch.setattr(bot.utils, "_signal_group", lambda proc, sig: proc.send_signal(sig))
+        monkeypatch.setattr(bot.utils, "_TERM_GRACE_SEC", 0.01)
+        return spawned
+
+    return install
+
+
+@pytest.mark.slow
 async def test_run_shell_echo() -> None:
     res = await run_shell("echo hello")
     assert res.returncode == 0
     assert res.stdout.decode("utf-8").strip() == "hello"
 
 
-@pytest.mark.asyncio
-async def test_run_shell_timeout() -> None:
+@pytest.mark.slow
+async def test_run_shell_falls_back_to_shell() -> None:
+    # Builtins and VAR=value prefixes cannot be exec'd directly
+    res = await run_shell("cd /")
+    assert res.returncode == 0
+    res = await run_shell("FOO=bar env")
+    assert b"FOO=bar" in res.stdout
+    # Shell syntax still goes through the shell
+    res = await run_shell("echo a | tr a b")
+    assert res.stdout.strip() == b"b"
+    res = await run_shell("definitely-not-a-command-xyz")
+    assert res.returncode == 127
+
+
+async def test_run_shell_timeout(fake_spawn: SpawnFake) -> None:
+    spawned = fake_spawn(duration=60)
+    res = await run_shell("sleep 60", timeout_sec=0.05)
+    assert res.returncode == 124
+    assert b"Timeout after" in res.stderr
+    # SIGTERM was honoured; the follow-up SIGKILL only sweeps the process group
+    assert spawned[0].signals == [signal.SIGTERM, signal.SIGKILL]
+    assert spawned[0].returncode == -signal.SIGTERM
+
+
+async def test_run_shell_timeout_kills_when_term_ignored(
+    fake_spawn: SpawnFake,
+) -> None:
+    spawned = fake_spawn(duration=60, ignore_term=True)
+    res = await run_shell("stubborn", timeout_sec=0.05)
+    assert res.returncode == 124
+    assert spawned[0].returncode == -signal.SIGKILL
+
+
+async def test_run_shell_finishes_before_timeout(
+    fake_spawn: SpawnFake,
+) -> None:
+    spawned = fake_spawn(duration=0.01)
+    res = await run_shell("quick", timeout_sec=5)
+    assert res.returncode == 0
+    assert spawned[0].signals == []
+
+
+@pytest.mark.slow
+async def test_run_shell_timeout_real_process() -> None:
     # sleep should exist on Linux/macOS
     res = await run_shell("sleep 2", timeout_sec=0.3)
     assert res.returncode == 124
     assert b"Timeout after" in res.stderr
+    res = await run_shell("trap '' TERM; sleep 2", timeout_sec=0.3)
+    assert res.returncode == 124
+
+
+@pytest.mark.slow
+async def test_run_shell_caps_output() -> None:
+    res = await run_shell("yes", timeout_sec=5, max_output_bytes=1000)
+    assert res.truncated
+    assert len(res.stdout) == 1000
+    assert res.stdout.startswith(b"y\ny\n")
 
 
 def test_text_preview_or_file_preview() -> None:
@@ -38,8 +151,23 @@ def test_text_preview_or_file_file(tmp_path: Path) -> None:
     p.unlink()
 
 
+def test_text_preview_or_file_spill_is_private_and_exact() -> None:
+    # Non-ASCII and lone surrogates must survive / be replaced, not raise, across chunk edges
+    body = "ж" * (_SPILL_CHUNK + 3000)
+    _, path = text_preview_or_file(body + "\udc80", max_chars=10)
+    assert path
+    p = Path(path)
+    try:
+        assert p.stat().st_mode & 0o777 == 0o600
+        assert p.read_bytes() == body.encode("utf-8") + b"?"
+    finally:
+        p.unlink()
+
+
 def test_human_bytes() -> None:
     assert human_bytes(0) == "0.00 B"
     assert human_bytes(1023).endswith("B")
     assert human_bytes(1024).endswith("KB")
     assert human_bytes(1024 * 1024).endswith("MB")
+    assert human_bytes(3 * 1024**5) == "3.00 PB"
+    assert human_bytes(1024**7) == "1024.00 EB"